@@ -6,11 +6,20 @@ Corrections: adressage exact et gestion int32 correcte
 
 import asyncio
 import logging
+import os
+import struct
+import sys
+from array import array
 from pymodbus import __version__ as pymodbus_version
 from pymodbus.server import StartAsyncTcpServer
-from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext, ModbusSparseDataBlock
+from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext, ModbusSequentialDataBlock
 from pymodbus.device import ModbusDeviceIdentification
 
+try:
+    import uvloop  # Boucle asyncio libuv (optionnelle, Linux/macOS)
+except ImportError:
+    uvloop = None
+
 # ---------------------------
 # Configuration logging
 # ---------------------------
@@ -20,61 +29,150 @@ log = logging.getLogger()
 # ---------------------------
 # Fonctions utilitaires int32 little-endian (comme votre client)
 # ---------------------------
-def split_int32_be(value):
-    """Split int32 en 2 registres 16-bit big-endian (HI, LO)"""
-    hi = (value >> 16) & 0xFFFF
-    lo = value & 0xFFFF
-    return [hi, lo]
+_INT32_BE = struct.Struct('>i')    # int32 signé big-endian
+_REGS_BE = struct.Struct('>HH')    # 2 registres 16-bit (HI, LO)
+
+def split_int32_be_into(buf, value):
+    """Split int32 en 2 registres 16-bit big-endian (HI, LO) écrits dans buf"""
+    buf[0] = (value >> 16) & 0xFFFF
+    buf[1] = value & 0xFFFF
+    return buf
 
 def merge_int32_be(hi, lo):
-    """Merge 2 registres 16-bit big-endian en int32"""
-    result = (hi << 16) + lo
-    # Conversion en int32 signé si nécessaire
-    if result > 0x7FFFFFFF:
-        result = result - 0x100000000
-    return result
+    """Merge 2 registres 16-bit big-endian en int32 (signe géré par struct)"""
+    return _INT32_BE.unpack(_REGS_BE.pack(hi, lo))[0]
 
 # ---------------------------
 # Datastore BESS personnalisé
 # ---------------------------
-class BessDataBlock(ModbusSparseDataBlock):
-    def __init__(self):
-        # Initialisation de TOUS les registres aux adresses EXACTES
-        values = {
-            # Holding Registers (écriture)
-            0xd000: 0,      # watchdog low
-            0xd001: 0,      # watchdog high
-            0xd002: 0,      # commande BESS low
-            0xd003: 0,      # commande BESS high
-            0xd004: 0,      # P command low
-            0xd005: 0,      # P command high  
-            0xd006: 0,      # Q command low
-            0xd007: 0,      # Q command high
-            0xd00a: 0,      # Clear Faults low
-            0xd00b: 0,      # Clear Faults high
-            
-            # Input Registers (lecture - miroir des commandes)
-            0x2502: 0,      # state low
-            0x2503: 0,      # state high
-            0x2504: 5000,   # SoC low (50.00%)
-            0x2505: 0,      # SoC high
-            0x2518: 0,      # P miroir low
-            0x2519: 0,      # P miroir high
-            0x251a: 0,      # Q miroir low
-            0x251b: 0,      # Q miroir high
-        }
+class BessRegisters:
+    """Holding (0xd000-0xd00b) et Input Registers (0x2502-0x251b) dans un seul array('H')
+
+    Exposés au serveur par deux blocs distincts, hr et ir, qui partagent ce
+    stockage. Les miroirs State/P/Q des Input Registers pointent directement
+    sur les commandes des Holding Registers : aucune recopie n'est nécessaire.
+    """
+
+    HR_ADDRESS, HR_SIZE = 0xd000, 12
+    IR_ADDRESS, IR_SIZE = 0x2502, 26
+
+    # Input Register miroir → Holding Register source
+    ALIASES = {
+        0x2502: 0xd002, 0x2503: 0xd003,     # State ← Command
+        0x2518: 0xd004, 0x2519: 0xd005,     # P_kW ← P_command
+        0x251a: 0xd006, 0x251b: 0xd007,     # Q_kVar ← Q_command
+    }
+
+    # Initialisation de TOUS les registres aux adresses EXACTES
+    INITIAL_VALUES = {
+        # Holding Registers (écriture)
+        0xd000: 0,      # watchdog low
+        0xd001: 0,      # watchdog high
+        0xd002: 0,      # commande BESS low
+        0xd003: 0,      # commande BESS high
+        0xd004: 0,      # P command low
+        0xd005: 0,      # P command high  
+        0xd006: 0,      # Q command low
+        0xd007: 0,      # Q command high
+        0xd00a: 0,      # Clear Faults low
+        0xd00b: 0,      # Clear Faults high
         
-        super().__init__(values)
-        log.info(f"DataBlock initialisé avec {len(values)} registres")
+        # Input Registers (lecture - miroir des commandes)
+        0x2502: 0,      # state low
+        0x2503: 0,      # state high
+        0x2504: 5000,   # SoC low (50.00%)
+        0x2505: 0,      # SoC high
+        0x2518: 0,      # P miroir low
+        0x2519: 0,      # P miroir high
+        0x251a: 0,      # Q miroir low
+        0x251b: 0,      # Q miroir high
+    }
+
+    def __init__(self):
+        # Stockage uint16 contigu : [Holding Registers | Input Registers]
+        # ir_offsets donne l'index de chaque Input Register dans ce stockage
+        self.values = array('H', bytes(2 * (self.HR_SIZE + self.IR_SIZE)))
+        self.ir_offsets = array('H', range(self.HR_SIZE, self.HR_SIZE + self.IR_SIZE))
+        for ir_reg, hr_reg in self.ALIASES.items():
+            self.ir_offsets[ir_reg - self.IR_ADDRESS] = hr_reg - self.HR_ADDRESS
+
+        self.hr = HoldingRegisterBlock(self)
+        self.ir = InputRegisterBlock(self)
+
+        for reg, value in self.INITIAL_VALUES.items():
+            block = self.hr if reg >= self.HR_ADDRESS else self.ir
+            block.setValues(reg, [value])
+        self.initial = array('H', self.values)
+        log.info("DataBlock initialisé avec %d registres", len(self.INITIAL_VALUES))
+
+    def reset(self):
+        """Remet les registres à leurs valeurs initiales"""
+        self.values[:] = self.initial
+
+class HoldingRegisterBlock(ModbusSequentialDataBlock):
+    """Holding Registers 0xd000-0xd00b (lecture/écriture client)"""
+
+    def __init__(self, registers):
+        super().__init__(registers.HR_ADDRESS, 0)
+        self.registers = registers
+        self.values = registers.values  # Partagé, getValues hérité = tranche directe
+
+    def reset(self):
+        """Remet les registres partagés à leurs valeurs initiales"""
+        self.registers.reset()
+
+    def validate(self, address, count=1):
+        """Vérifie que [address, address + count) tient dans 0xd000-0xd00b"""
+        return self.address <= address and address + count <= self.address + self.registers.HR_SIZE
+
+    def setValues(self, address, values):
+        """Écrit les registres (les miroirs IR voient la valeur immédiatement)"""
+        if not isinstance(values, list):
+            values = [values]
+        start = address - self.address
+        self.values[start:start + len(values)] = array('H', values)
+
+class InputRegisterBlock(ModbusSequentialDataBlock):
+    """Input Registers 0x2502-0x251b (lecture client, écriture par l'updater)"""
+
+    def __init__(self, registers):
+        super().__init__(registers.IR_ADDRESS, 0)
+        self.registers = registers
+        self.values = registers.values
+        self.offsets = registers.ir_offsets
+
+    def reset(self):
+        """Remet les registres partagés à leurs valeurs initiales"""
+        self.registers.reset()
+
+    def validate(self, address, count=1):
+        """Vérifie que [address, address + count) tient dans 0x2502-0x251b"""
+        return self.address <= address and address + count <= self.address + self.registers.IR_SIZE
+
+    def getValues(self, address, count=1):
+        """Lit les registres via ir_offsets (miroirs lus dans les Holding Registers)"""
+        start = address - self.address
+        values = self.values
+        return [values[i] for i in self.offsets[start:start + count]]
+
+    def setValues(self, address, values):
+        """Écrit les registres (réservé à l'updater, aucun code fonction client)"""
+        if not isinstance(values, list):
+            values = [values]
+        start = address - self.address
+        for i, value in zip(self.offsets[start:start + len(values)], values):
+            self.values[i] = value
 
 # ---------------------------
 # Contexte Modbus avec adressage exact
 # ---------------------------
+registers = BessRegisters()
+
 store = ModbusSlaveContext(
-    hr=BessDataBlock(),      # Holding registers
-    ir=BessDataBlock(),      # Input registers (même mapping pour simplifier)
-    co=BessDataBlock(),      # Coils (pas utilisé mais requis)
-    di=BessDataBlock(),      # Discrete inputs (pas utilisé mais requis)
+    hr=registers.hr,         # Holding registers
+    ir=registers.ir,         # Input registers (même stockage : miroirs sans recopie)
+    co=ModbusSequentialDataBlock(0x00, [0]),  # Coils (pas utilisé mais requis)
+    di=ModbusSequentialDataBlock(0x00, [0]),  # Discrete inputs (pas utilisé mais requis)
     zero_mode=True           # IMPORTANT: adressage à partir de 0 (pas de décalage -1)
 )
 
@@ -95,103 +193,133 @@ identity.MajorMinorRevision = pymodbus_version
 # Variables de simulation
 # ---------------------------
 soc_value = 5000  # 50.00%
+soc_tick = 0      # Secondes écoulées (sens de variation du SOC)
+soc_registers = [0, 0]  # Buffer (HI, LO) réutilisé, setValues copie les valeurs
 watchdog_timeout = 0
 
 # ---------------------------
 # Updater asynchrone pour synchronisation
 # ---------------------------
 async def updater():
-    global soc_value, watchdog_timeout
-    log.info("🔄 Updater démarré - Synchronisation automatique activée")
+    """Exécute la boucle de simulation et la relance après une erreur"""
+    log.info("🔄 Updater démarré - Simulation SOC et watchdog")
     
     while True:
         try:
-            # Lecture des commandes depuis Holding Registers (fonction 3)
-            
-            # Command (0xd002-0xd003) → State (0x2502-0x2503)
-            cmd_lo = context[0].getValues(3, 0xd002, count=1)[0]
-            cmd_hi = context[0].getValues(3, 0xd003, count=1)[0]
-            cmd_32 = merge_int32_be(cmd_lo, cmd_hi)
-            context[0].setValues(4, 0x2502, split_int32_be(cmd_32))
-            
-            # P_command (0xd004-0xd005) → P_kW (0x2518-0x2519)
-            p_cmd_lo = context[0].getValues(3, 0xd004, count=1)[0]
-            p_cmd_hi = context[0].getValues(3, 0xd005, count=1)[0]
-            p_cmd_32 = merge_int32_be(p_cmd_lo, p_cmd_hi)
-            context[0].setValues(4, 0x2518, split_int32_be(p_cmd_32))
-            
-            # Q_command (0xd006-0xd007) → Q_kVar (0x251a-0x251b)
-            q_cmd_lo = context[0].getValues(3, 0xd006, count=1)[0]
-            q_cmd_hi = context[0].getValues(3, 0xd007, count=1)[0]
-            q_cmd_32 = merge_int32_be(q_cmd_lo, q_cmd_hi)
-            context[0].setValues(4, 0x251a, split_int32_be(q_cmd_32))
-            
-            # Watchdog
-            wd_lo = context[0].getValues(3, 0xd000, count=1)[0]
-            wd_hi = context[0].getValues(3, 0xd001, count=1)[0]
-            watchdog_32 = merge_int32_be(wd_lo, wd_hi)
-            
-            # Check si watchdog a été mis à jour
-            if watchdog_32 != 0:
-                watchdog_timeout = 0
-                log.debug(f"✅ Watchdog reçu: {watchdog_32}")
-            else:
-                watchdog_timeout += 1
-                if watchdog_timeout > 10:  # 10 secondes sans watchdog
-                    log.warning("⚠️  Watchdog timeout!")
-            
-            # Simulation du SOC qui varie lentement
-            import time
-            soc_direction = -1 if (time.time() % 60) < 30 else 1
-            soc_value += soc_direction
-            soc_value = max(1000, min(9500, soc_value))  # 10% à 95%
-            context[0].setValues(4, 0x2504, split_int32_be(soc_value))
-            
-                
-        except Exception as e:
-            log.error(f"Erreur dans updater: {e}")
+            await simulation_loop()
+        except Exception:
+            log.exception("Erreur dans updater, redémarrage de la boucle")
+            await asyncio.sleep(1)
+
+async def simulation_loop():
+    """Watchdog et SOC une fois par seconde (sans try/except dans la boucle)"""
+    global soc_value, soc_tick, watchdog_timeout
+    # Les miroirs State/P/Q sont servis directement par BessRegisters.
+    # Accès direct aux blocs, sans context[0] ni résolution du code
+    # fonction (zero_mode : mêmes adresses que côté client).
+
+    while True:
+        # Check si watchdog a été mis à jour
+        wd_lo, wd_hi = registers.hr.getValues(0xd000, count=2)
+        if wd_lo | wd_hi:
+            watchdog_timeout = 0
+            log.debug("✅ Watchdog reçu: %s", merge_int32_be(wd_lo, wd_hi))
+        else:
+            watchdog_timeout += 1
+            if watchdog_timeout > 10:  # 10 secondes sans watchdog
+                log.warning("⚠️  Watchdog timeout!")
+        
+        # Simulation du SOC qui varie lentement (décharge 30 s, charge 30 s)
+        soc_direction = -1 if soc_tick < 30 else 1
+        soc_tick = (soc_tick + 1) % 60
+        soc_value += soc_direction
+        soc_value = max(1000, min(9500, soc_value))  # 10% à 95%
+        registers.ir.setValues(0x2504, split_int32_be_into(soc_registers, soc_value))
         
         await asyncio.sleep(1)  # Mise à jour chaque seconde
 
+def log_updater_exit(task):
+    """Journalise l'arrêt de l'updater s'il se termine sur une exception"""
+    if not task.cancelled() and task.exception() is not None:
+        log.error("❌ Updater arrêté sur exception", exc_info=task.exception())
+
+# Référence conservée pour éviter la collecte de la tâche et permettre son annulation
+updater_task = None
+
+# ---------------------------
+# Priorité et affinité CPU du processus
+# ---------------------------
+def configure_process(cpu=None, nice=None):
+    """Épingle le processus sur le CPU `cpu` et applique `nice` (best effort)
+
+    Rien n'est modifié pour un argument à None : l'ordonnancement par défaut
+    est conservé tant que l'opérateur ne le demande pas explicitement.
+    """
+    # Boucle asyncio mono-thread : un seul cœur évite les migrations (gigue)
+    if cpu is not None and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, {cpu})
+            log.info("📌 Processus épinglé sur le CPU %d", cpu)
+        except OSError as e:
+            log.warning("⚠️  Affinité CPU inchangée: %s", e)
+    
+    # nice négatif : nécessite root ou CAP_SYS_NICE
+    if nice is not None and hasattr(os, "nice"):
+        try:
+            os.nice(nice)
+            log.info("⏫ Priorité du processus ajustée (nice %+d)", nice)
+        except OSError as e:
+            log.warning("⚠️  Priorité inchangée: %s", e)
+
+# ---------------------------
+# Bannière de démarrage (construite une fois, écrite en un seul appel)
+# ---------------------------
+BANNER = (
+    f"{'=' * 60}\n"
+    "🔋 SERVEUR MODBUS BESS - Version Corrigée\n"
+    f"📦 pymodbus {pymodbus_version}\n"
+    "🌐 Adresse: localhost:5502\n"
+    f"{'=' * 60}\n"
+    "📋 REGISTRES CONFIGURÉS:\n"
+    "   📝 Holding Registers (Fonction 03/06/16 - Écriture):\n"
+    "      0xd000-d001: Watchdog (int32)\n"
+    "      0xd002-d003: Commande système (int32)\n"
+    "      0xd004-d005: Consigne P kW (int32 signé)\n"
+    "      0xd006-d007: Consigne Q kVar (int32 signé)\n"
+    "      0xd00a-d00b: Clear faults (int32)\n"
+    "   📖 Input Registers (Fonction 04 - Lecture):\n"
+    "      0x2502-2503: État système (int32)\n"
+    "      0x2504-2505: SOC % × 100 (int32)\n"
+    "      0x2518-2519: P mesurée kW (int32 signé)\n"
+    "      0x251a-251b: Q mesurée kVar (int32 signé)\n"
+    "\n"
+    "🔄 SYNCHRONISATIONS AUTOMATIQUES (temps réel):\n"
+    "   • 0xd004-d005 → 0x2518-2519 (P_command → P_kW)\n"
+    "   • 0xd006-d007 → 0x251a-251b (Q_command → Q_kVar)\n"
+    "   • 0xd002-d003 → 0x2502-2503 (Command → State)\n"
+    "\n"
+    "✅ CORRECTIONS APPLIQUÉES:\n"
+    "   • zero_mode=True : Adresses exactes (pas de décalage -1)\n"
+    "   • Format int32 little-endian compatible avec votre client\n"
+    "   • Miroirs lus directement dans les Holding Registers (sans recopie)\n"
+    "\n"
+    "🚀 Serveur prêt... (Ctrl+C pour arrêter)\n"
+    f"{'=' * 60}\n"
+)
+
 # ---------------------------
 # Fonction principale du serveur
 # ---------------------------
 async def run_server():
     """Démarre le serveur avec l'updater en parallèle"""
     
-    print("=" * 60)
-    print("🔋 SERVEUR MODBUS BESS - Version Corrigée")
-    print(f"📦 pymodbus {pymodbus_version}")
-    print(f"🌐 Adresse: localhost:5502")
-    print("=" * 60)
-    print("📋 REGISTRES CONFIGURÉS:")
-    print("   📝 Holding Registers (Fonction 03/06/16 - Écriture):")
-    print("      0xd000-d001: Watchdog (int32)")
-    print("      0xd002-d003: Commande système (int32)")
-    print("      0xd004-d005: Consigne P kW (int32 signé)")
-    print("      0xd006-d007: Consigne Q kVar (int32 signé)")
-    print("      0xd00a-d00b: Clear faults (int32)")
-    print("   📖 Input Registers (Fonction 04 - Lecture):")
-    print("      0x2502-2503: État système (int32)")
-    print("      0x2504-2505: SOC % × 100 (int32)")
-    print("      0x2518-2519: P mesurée kW (int32 signé)")
-    print("      0x251a-251b: Q mesurée kVar (int32 signé)")
-    print()
-    print("🔄 SYNCHRONISATIONS AUTOMATIQUES (temps réel):")
-    print("   • 0xd004-d005 → 0x2518-2519 (P_command → P_kW)")
-    print("   • 0xd006-d007 → 0x251a-251b (Q_command → Q_kVar)")
-    print("   • 0xd002-d003 → 0x2502-2503 (Command → State)")
-    print()
-    print("✅ CORRECTIONS APPLIQUÉES:")
-    print("   • zero_mode=True : Adresses exactes (pas de décalage -1)")
-    print("   • Format int32 little-endian compatible avec votre client")
-    print("   • Synchronisation temps réel toutes les secondes")
-    print()
-    print("🚀 Serveur prêt... (Ctrl+C pour arrêter)")
-    print("=" * 60)
+    sys.stdout.write(BANNER)
+    sys.stdout.flush()
     
     # Démarrage de l'updater en parallèle
-    asyncio.create_task(updater())
+    global updater_task
+    updater_task = asyncio.create_task(updater(), name="bess-updater")
+    updater_task.add_done_callback(log_updater_exit)
     
     # Démarrage du serveur Modbus
     await StartAsyncTcpServer(
@@ -206,6 +334,16 @@ async def run_server():
 if __name__ == "__main__":
     print("🚀 Démarrage du serveur Modbus BESS...")
     
+    # Opt-in : BESS_CPU=<index du CPU> et/ou BESS_NICE=<incrément, ex. -5>
+    configure_process(
+        cpu=int(os.environ["BESS_CPU"]) if "BESS_CPU" in os.environ else None,
+        nice=int(os.environ["BESS_NICE"]) if "BESS_NICE" in os.environ else None,
+    )
+    
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        print(f"⚡ Boucle d'événements uvloop {uvloop.__version__}")
+    
     try:
         asyncio.run(run_server())
     except KeyboardInterrupt:
@@ -0,0 +1,66 @@
+"""Tests du datastore BESS (python -m unittest)"""
+
+import unittest
+
+from pymodbus.datastore import ModbusSlaveContext
+
+from server import BessRegisters, merge_int32_be, split_int32_be_into
+
+
+class Int32Test(unittest.TestCase):
+    def test_split_merge_round_trip(self):
+        buf = [0, 0]
+        for value in (0, 5000, -1, -1000, 0x7FFFFFFF, -0x80000000):
+            self.assertIs(split_int32_be_into(buf, value), buf)
+            self.assertEqual(merge_int32_be(*buf), value)
+        self.assertEqual(split_int32_be_into(buf, -2), [0xFFFF, 0xFFFE])
+
+
+class BessRegistersTest(unittest.TestCase):
+    def setUp(self):
+        self.registers = BessRegisters()
+        self.slave = ModbusSlaveContext(hr=self.registers.hr, ir=self.registers.ir, zero_mode=True)
+
+    def test_hr_window(self):
+        hr = self.registers.hr
+        self.assertTrue(hr.validate(0xd000, 12))
+        self.assertFalse(hr.validate(0xcfff, 1))
+        self.assertFalse(hr.validate(0xd00b, 2))
+        self.assertFalse(hr.validate(0x2504, 1))
+        self.assertFalse(hr.validate(0x2518, 4))
+
+    def test_ir_window(self):
+        ir = self.registers.ir
+        self.assertTrue(ir.validate(0x2502, 26))
+        self.assertFalse(ir.validate(0x2501, 1))
+        self.assertFalse(ir.validate(0x251b, 2))
+        self.assertFalse(ir.validate(0xd000, 1))
+
+    def test_function_codes_stay_in_their_window(self):
+        self.assertFalse(self.slave.validate(6, 0x2504))       # écriture HR sur le SOC
+        self.assertFalse(self.slave.validate(16, 0x251a, 2))   # écriture HR sur le miroir Q
+        self.assertFalse(self.slave.validate(3, 0x2518, 4))    # lecture HR des miroirs
+        self.assertFalse(self.slave.validate(4, 0xd000, 2))    # lecture IR des commandes
+        self.assertTrue(self.slave.validate(16, 0xd000, 8))
+        self.assertTrue(self.slave.validate(4, 0x2502, 26))
+
+    def test_mirrors_alias_commands(self):
+        self.slave.setValues(16, 0xd002, [1, 2, 3, 4, 5, 6])
+        self.assertEqual(list(self.slave.getValues(4, 0x2502, 2)), [1, 2])
+        self.assertEqual(list(self.slave.getValues(4, 0x2518, 4)), [3, 4, 5, 6])
+
+    def test_ir_write_does_not_touch_hr(self):
+        self.registers.ir.setValues(0x2504, [0, 4999])
+        self.assertEqual(list(self.registers.ir.getValues(0x2504, 2)), [0, 4999])
+        self.assertEqual(list(self.registers.hr.getValues(0xd000, 12)), [0] * 12)
+
+    def test_reset(self):
+        self.registers.hr.setValues(0xd004, [7, 8])
+        self.registers.ir.setValues(0x2504, [0, 1234])
+        self.registers.ir.reset()
+        self.assertEqual(list(self.registers.hr.getValues(0xd004, 2)), [0, 0])
+        self.assertEqual(list(self.registers.ir.getValues(0x2504, 2)), [5000, 0])
+
+
+if __name__ == "__main__":
+    unittest.main()